@@ -2,54 +2,124 @@ import streamlit as st
 from datetime import datetime
 import re
 import os
+import zipfile
+from bisect import bisect_left, bisect_right
 from io import BytesIO
-from docx import Document
+from itertools import accumulate
+from xml.sax.saxutils import escape
+from lxml import etree
+
+# characters not allowed in download file names
+_UNSAFE_PO = re.compile(r'[\\/:*?"<>|]')
+# file name suffix per template code
+_SUFFIX = {"001": "MOD", "002": "FAR"}
 
 # ----------------- Replacement helpers -----------------
-def replace_in_paragraph_by_text(paragraph, mapping):
-    """
-    Replace tokens by working with the full paragraph text.
-    This handles tokens split across runs because it rewrites the whole paragraph text.
-    """
-    text = paragraph.text
-    new_text = text
-    for key, val in mapping.items():
-        if key in new_text:
-            new_text = new_text.replace(key, val)
-    if new_text != text:
-        # assign new text (this replaces runs)
-        paragraph.text = new_text
-
-def replace_text_in_table(table, mapping):
-    for row in table.rows:
-        for cell in row.cells:
-            replace_text_in_block(cell, mapping)
-
-def replace_text_in_block(block, mapping):
-    """
-    Replace tokens in a Document, Header, Footer, or _Cell block.
-    """
-    for paragraph in getattr(block, "paragraphs", []):
-        replace_in_paragraph_by_text(paragraph, mapping)
-    for table in getattr(block, "tables", []):
-        replace_text_in_table(table, mapping)
-
-def apply_replacements(doc, mapping):
-    # body
-    replace_text_in_block(doc, mapping)
-    # headers/footers
-    for section in doc.sections:
-        try:
-            replace_text_in_block(section.header, mapping)
-        except Exception:
-            pass
-        try:
-            replace_text_in_block(section.footer, mapping)
-        except Exception:
-            pass
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+# characters XML 1.0 does not allow in text (control characters, surrogates, U+FFFE/U+FFFF)
+_XML_INVALID_RE = re.compile("[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+
+def _build_replacer(tokens):
+    """
+    Compile one regex for all tokens, capturing the field name without braces.
+    "{{B1}}" and "B1" both yield "B1", so look values up with _field_name(match).
+    """
+    braced = [t[2:-2] for t in tokens if t.startswith("{{")]
+    bare = [t for t in tokens if not t.startswith("{{")]
+    alternatives = []
+    for fmt, names in ((r"\{\{(%s)\}\}", braced), ("(%s)", bare)):
+        if names:
+            # longest first so a name never loses to its own prefix
+            alternatives.append(fmt % "|".join(re.escape(n) for n in sorted(names, key=len, reverse=True)))
+    return re.compile("|".join(alternatives))
+
+def _field_name(m):
+    # exactly one of the braced/bare groups takes part in a match
+    return m.group(m.lastindex)
+
+def _has_marker(text, markers):
+    return any(m in text for m in markers)
+
+def _set_w_t_text(t, text):
+    t.text = text
+    if text != text.strip():
+        t.set(_XML_SPACE, "preserve")
+
+def iter_text_elements(element):
+    """
+    Yield every <w:t> under element, grouped by its nearest <w:p>, in one tree walk.
+    Runs inside w:ins, w:sdt, w:smartTag, w:fldSimple etc. count; a nested paragraph
+    (e.g. a text box) starts a new group, the same way _paragraph_texts splits raw XML.
+    """
+    para, ts = None, []
+    for el in element.iter(_W + "p", _W + "t"):
+        # every <w:p> start is a boundary, even one without text
+        p = el if el.tag == _W + "p" else next(el.iterancestors(_W + "p"), None)
+        if p is not para:
+            if ts:
+                yield ts
+            para, ts = p, []
+        if el is not p:
+            ts.append(el)
+    if ts:
+        yield ts
+
+def replace_in_text_elements(ts, pattern, mapping, markers):
+    """
+    Replace tokens in the <w:t> elements of one paragraph.
+    A token split across runs is written into the run where it starts,
+    so every run keeps its own formatting.
+    """
+    texts = [t.text or "" for t in ts]
+    text = "".join(texts)
+    if not _has_marker(text, markers):
+        return
+    matches = list(pattern.finditer(text))
+    if not matches:
+        return
+    ends = list(accumulate(map(len, texts)))
+    new = texts[:]
+    # right to left, so earlier offsets stay valid
+    for m in reversed(matches):
+        i = bisect_right(ends, m.start())
+        j = bisect_left(ends, m.end())
+        start = m.start() - (ends[i] - len(texts[i]))
+        end = m.end() - (ends[j] - len(texts[j]))
+        value = mapping[_field_name(m)]
+        if i == j:
+            new[i] = new[i][:start] + value + new[i][end:]
+        else:
+            new[i] = new[i][:start] + value
+            new[j] = new[j][end:]
+            for k in range(i + 1, j):
+                new[k] = ""
+    for t, old, text in zip(ts, texts, new):
+        if text != old:
+            _set_w_t_text(t, text)
 
 # ----------------- Template lookup -----------------
+# placeholder spellings each template code is filled with; patterns are compiled once at import
+_PSS_TOKENS = ["{{DD/MM/YYYY}}", "DD/MM/YYYY", "{{PO012}}"] + [
+    key for i in range(1, 5) for key in (f"{{{{B{i}}}}}", f"B{i}")
+]
+TEMPLATE_TOKENS = {"001": _PSS_TOKENS, "002": _PSS_TOKENS}
+TEMPLATE_PATTERNS = {code: _build_replacer(tokens) for code, tokens in TEMPLATE_TOKENS.items()}
+
+def build_mapping(date_str, po_value, batches):
+    """
+    Map each field name to its value; "{{B1}}" and "B1" both look up "B1".
+    """
+    mapping = {"DD/MM/YYYY": date_str, "PO012": po_value}
+    mapping.update((f"B{i}", val) for i, val in enumerate(batches, start=1))
+    return mapping
+
+@st.cache_data(ttl=300)
 def find_local_template_for_code(code):
+    """
+    Resolve the template path for a code; cached so repeat submits skip the stat calls.
+    The TTL lets a template dropped in later (or a missing one) be picked up without a restart.
+    """
     code = (code or "").strip()
     if code == "001":
         candidates = ["MOD PSS.docx", "/mnt/data/MOD PSS.docx", "templates/MOD PSS.docx"]
@@ -63,13 +133,118 @@ def find_local_template_for_code(code):
     return None
 
 # ----------------- Create filled docx -----------------
-def create_docx_from_template_file(path, mapping):
-    doc = Document(path)
-    apply_replacements(doc, mapping)
+@st.cache_resource(max_entries=len(TEMPLATE_TOKENS))
+def _load_template_bytes(path, mtime):
+    """
+    Read a template once per app process; every fill works on a copy of these bytes.
+    mtime is only part of the cache key, so editing a template on disk invalidates it;
+    max_entries keeps one copy per template instead of one per edit.
+    """
+    with open(path, "rb") as f:
+        return f.read()
+
+# deflate level for the filled docx: level 1 is several times faster than zlib's default
+# and only slightly larger, which suits a download served straight from the app
+_ZIP_LEVEL = 1
+_TEXT_PART_RE = re.compile(r"word/(document|header\d*|footer\d*)\.xml$")
+_W_T_RE = re.compile(rb"(<w:t(?:\s[^>]*)?>)([^<]*)(</w:t>)")
+# a paragraph boundary (<w:p ...>, <w:p/>, </w:p>) or the text of one <w:t>
+_PART_SCAN_RE = re.compile(rb"<w:p[\s>/]|</w:p>|<w:t(?:\s[^>]*)?>([^<]*)</w:t>")
+
+def _paragraph_texts(xml):
+    """
+    Yield the <w:t> texts of a raw XML part, grouped the way iter_text_elements groups elements.
+    """
+    texts = []
+    for m in _PART_SCAN_RE.finditer(xml):
+        if m.group(1) is None:
+            if texts:
+                yield texts
+            texts = []
+        else:
+            texts.append(m.group(1))
+    if texts:
+        yield texts
+
+def _fill_xml_part(xml, pattern, mapping, markers):
+    """
+    Replace tokens inside the <w:t> elements of a raw XML part, as UTF-8 bytes.
+    Returns None when a token is split across <w:t> elements of one paragraph.
+    """
+    found = False
+    for texts in _paragraph_texts(xml):
+        joined = b"".join(texts)
+        if not _has_marker(joined, markers):
+            continue
+        spans = [m.span() for m in pattern.finditer(joined)]
+        if not spans:
+            continue
+        found = True
+        # every match in the paragraph must also be found inside a single <w:t>
+        node_spans = []
+        offset = 0
+        for text in texts:
+            if _has_marker(text, markers):
+                node_spans.extend((offset + m.start(), offset + m.end()) for m in pattern.finditer(text))
+            offset += len(text)
+        if node_spans != spans:
+            return None
+    if not found:
+        return xml
+    repl = lambda m: mapping[_field_name(m)]
+
+    def fill(m):
+        if not _has_marker(m.group(2), markers):
+            return m.group(0)
+        start, text = m.group(1), pattern.sub(repl, m.group(2))
+        if text != text.strip() and b"xml:space" not in start:
+            start = b'<w:t xml:space="preserve">'
+        return start + text + m.group(3)
+
+    return _W_T_RE.sub(fill, xml)
+
+def _fill_part_tree(part, pattern, mapping, markers):
+    """
+    Parse one XML part and replace tokens run by run; used when Word split a token.
+    """
+    root = etree.fromstring(part)
+    # tables and cells are just deeper descendants
+    for ts in iter_text_elements(root):
+        replace_in_text_elements(ts, pattern, mapping, markers)
+    return etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+
+def _fill_docx_parts(data, pattern, mapping):
+    """
+    Fill tokens in the zipped document/header/footer XML, copying every other part verbatim.
+    Parts are patched as text; only a part with a token split across runs is parsed.
+    """
+    for name, val in mapping.items():
+        # values are spliced into raw XML, so reject what Word could not parse back
+        if _XML_INVALID_RE.search(val):
+            raise ValueError(f"Value for {name} contains characters that cannot be stored in a .docx")
+    # every match contains its field name, so the names double as cheap markers
+    markers = tuple(mapping)
+    # tokens are ASCII, so the text pass can run on the UTF-8 bytes without decoding;
+    # re.compile's own cache makes the bytes pattern a lookup after the first fill
+    byte_pattern = re.compile(pattern.pattern.encode("utf-8"))
+    byte_mapping = {k.encode("utf-8"): escape(v).encode("utf-8") for k, v in mapping.items()}
+    byte_markers = tuple(m.encode("utf-8") for m in markers)
     out = BytesIO()
-    doc.save(out)
-    out.seek(0)
-    return out.read()
+    with zipfile.ZipFile(BytesIO(data)) as src, zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            part = src.read(info.filename)
+            if _TEXT_PART_RE.match(info.filename):
+                xml = _fill_xml_part(part, byte_pattern, byte_mapping, byte_markers)
+                if xml is None:
+                    xml = _fill_part_tree(part, pattern, mapping, markers)
+                part = xml
+            # the template's ZipInfo carries no level, so pass the fast one explicitly
+            dst.writestr(info, part, compresslevel=_ZIP_LEVEL)
+    return out.getvalue()
+
+def create_docx_from_template_file(path, pattern, mapping):
+    data = _load_template_bytes(path, os.path.getmtime(path))
+    return _fill_docx_parts(data, pattern, mapping)
 
 # ----------------- Streamlit UI -----------------
 st.set_page_config(page_title="PSS Generator")
@@ -101,22 +276,8 @@ if submitted:
     date_str_final = date_picker.strftime("%d/%m/%Y")
 
     # Build mapping
-    mapping = {}
-    mapping["{{DD/MM/YYYY}}"] = date_str_final
-    mapping["DD/MM/YYYY"] = date_str_final
-
     po_value = po_id.strip() if po_id and po_id.strip() else "PO012"
-    for key in ["{{PO012}}"]:
-        mapping[key] = po_value
-
-    mapping["{{B1}}"] = b1
-    mapping["B1"] = b1
-    mapping["{{B2}}"] = b2
-    mapping["B2"] = b2
-    mapping["{{B3}}"] = b3
-    mapping["B3"] = b3
-    mapping["{{B4}}"] = b4
-    mapping["B4"] = b4
+    mapping = build_mapping(date_str_final, po_value, [b1, b2, b3, b4])
 
     template_path = find_local_template_for_code(user_code)
 
@@ -127,13 +288,13 @@ if submitted:
         )
     else:
         try:
-            final_bytes = create_docx_from_template_file(template_path, mapping)
+            final_bytes = create_docx_from_template_file(template_path, TEMPLATE_PATTERNS[user_code], mapping)
 
             # filename
-            suffix = "MOD" if user_code == "001" else "FAR" if user_code == "002" else "GEN"
-            safe_po = re.sub(r'[\/:*?"<>|]', '', po_value)
+            suffix = _SUFFIX.get(user_code, "GEN")
+            safe_po = _UNSAFE_PO.sub('', po_value)
             po_suffix = safe_po[-3:] if len(safe_po) >= 3 else "000"
-            filename = f"PSS {suffix} LIPL {po_suffix} {int(current_container)} of {int(total_containers)}.docx"
+            filename = f"PSS {suffix} LIPL {po_suffix} {current_container} of {total_containers}.docx"
 
             st.session_state.docx_bytes = final_bytes
             st.session_state.filename = filename